@@ -1,38 +1,70 @@
+import asyncio
+import functools
 import os
+import re
+import shutil
+import threading
+import uuid
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
 from typing import Annotated
 from typing_extensions import TypedDict
+import aiofiles
 from langgraph.graph.message import add_messages
 from langchain.chat_models import init_chat_model
 from langgraph.prebuilt import ToolNode, tools_condition
 from langgraph.graph import StateGraph, START, END
 from langchain_core.tools import tool
-from langchain_core.messages import SystemMessage
+from langchain_core.messages import AIMessage, RemoveMessage, SystemMessage, ToolMessage, trim_messages
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from .plan_cache import PlanCache, ReplayCache
 
 
 class State(TypedDict):
     messages: Annotated[list, add_messages]
+    latest_user: str | None
+    summary: str | None
     rewritten_prompt: str | None
     plan: str | None
+    replayed: bool | None
+    replay_rounds: list | None
 
 
 CHAT_GPT_DIR = "chat_gpt"
 
+# Folder and file names must be a single plain path component
+_SAFE_NAME = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+
+
+def _resolve(folder: str | None, filename: str | None = None) -> Path:
+    """Validate `folder` / `filename` and return the path they name under chat_gpt/.
+
+    Raises ValueError for separators, "..", empty strings and other unsafe names.
+    """
+    parts = []
+    for name in (folder, filename):
+        if name is None:
+            continue
+        name = name.strip()
+        if not _SAFE_NAME.match(name) or name in (".", ".."):
+            raise ValueError(f"invalid name {name!r}; use 1-128 letters, digits, '.', '_' or '-'")
+        parts.append(name)
+    return Path(CHAT_GPT_DIR).joinpath(*parts)
+
 
 @tool
 def create_folder(folder_name: str) -> str:
     """Create a folder inside chat_gpt/ with the given name."""
-    os.makedirs(CHAT_GPT_DIR, exist_ok=True)
-    safe_name = os.path.basename(folder_name.strip())
-    path = os.path.join(CHAT_GPT_DIR, safe_name)
     try:
-        os.makedirs(path, exist_ok=True)
+        path = _resolve(folder_name)
+        path.mkdir(parents=True, exist_ok=True)
         return f"Folder created at {path}"
     except Exception as e:
         return f"Failed to create folder: {e}"
 
 
 @tool
-def create_code_file(filename: str, content: str, folder_name: str | None = None) -> str:
+async def create_code_file(filename: str, content: str, folder_name: str | None = None) -> str:
     """Create or overwrite a code file inside the chat_gpt/ (or a subfolder) with the given content.
 
     Args:
@@ -40,204 +72,465 @@ def create_code_file(filename: str, content: str, folder_name: str | None = None
         content: Full file content to write.
         folder_name: Optional subfolder under chat_gpt/, e.g. "netflix_landing".
     """
-    base_dir = CHAT_GPT_DIR
-    if folder_name:
-        base_dir = os.path.join(CHAT_GPT_DIR, os.path.basename(folder_name.strip()))
-    os.makedirs(base_dir, exist_ok=True)
-    safe_name = os.path.basename(filename)
-    path = os.path.join(base_dir, safe_name)
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(content)
+        path = _resolve(folder_name or None, filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        async with aiofiles.open(path, "w", encoding="utf-8") as f:
+            await f.write(content)
         return f"File created/updated at {path}"
     except Exception as e:
         return f"Failed to create/update file: {e}"
 
 
 @tool
-def delete_folder(folder_name: str) -> str:
+async def delete_folder(folder_name: str) -> str:
     """Delete a folder inside chat_gpt/ and all of its contents."""
-    import shutil
-
-    base = os.path.join(CHAT_GPT_DIR, os.path.basename(folder_name.strip()))
-    if not os.path.exists(base):
+    try:
+        base = _resolve(folder_name)
+    except ValueError as e:
+        return f"Failed to delete folder: {e}"
+    if not base.exists():
         return f"Folder {base} does not exist."
     try:
-        shutil.rmtree(base)
+        await asyncio.to_thread(shutil.rmtree, base)
         return f"Folder {base} has been deleted."
     except Exception as e:
         return f"Failed to delete folder: {e}"
 
 
 @tool
-def delete_file(filename: str, folder_name: str | None = None) -> str:
+async def delete_file(filename: str, folder_name: str | None = None) -> str:
     """Delete a file inside chat_gpt/ (or a subfolder)."""
-    base_dir = CHAT_GPT_DIR
-    if folder_name:
-        base_dir = os.path.join(CHAT_GPT_DIR, os.path.basename(folder_name.strip()))
-    path = os.path.join(base_dir, os.path.basename(filename))
-    if not os.path.exists(path):
+    try:
+        path = _resolve(folder_name or None, filename)
+    except ValueError as e:
+        return f"Failed to delete file: {e}"
+    if not path.exists():
         return f"File {path} does not exist."
     try:
-        os.remove(path)
+        await asyncio.to_thread(os.remove, path)
         return f"File {path} has been deleted."
     except Exception as e:
         return f"Failed to delete file: {e}"
 
 
+# The project server is started once and reused by later run_project calls
+_HTTPD: ThreadingHTTPServer | None = None
+_HTTPD_THREAD: threading.Thread | None = None
+_HTTPD_LOCK = threading.Lock()
+
+
 @tool
 def run_project() -> str:
     """Start a simple HTTP server to serve files from the chat_gpt/ folder at http://localhost:8000."""
-    import threading
-    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
-
-    try:
-        os.makedirs(CHAT_GPT_DIR, exist_ok=True)
-        os.chdir(CHAT_GPT_DIR)
-    except Exception as e:
-        return f"Failed to prepare project directory: {e}"
-
-    def serve():
-        with ThreadingHTTPServer(("localhost", 8000), SimpleHTTPRequestHandler) as httpd:
-            httpd.serve_forever()
-
-    thread = threading.Thread(target=serve, daemon=True)
-    thread.start()
+    global _HTTPD, _HTTPD_THREAD
+
+    with _HTTPD_LOCK:
+        if _HTTPD is not None:
+            return "Project server already running at http://localhost:8000"
+
+        try:
+            os.makedirs(CHAT_GPT_DIR, exist_ok=True)
+            # Serve CHAT_GPT_DIR directly instead of chdir-ing the whole process
+            handler = functools.partial(SimpleHTTPRequestHandler, directory=CHAT_GPT_DIR)
+            _HTTPD = ThreadingHTTPServer(("localhost", 8000), handler)
+        except Exception as e:
+            return f"Failed to start project server: {e}"
+
+        _HTTPD_THREAD = threading.Thread(target=_HTTPD.serve_forever, daemon=True)
+        _HTTPD_THREAD.start()
     return "Project server started at http://localhost:8000"
 
 
+_TOOLS = [create_folder, create_code_file, delete_folder, delete_file, run_project]
+# The tool set is fixed, so its OpenAI function-call JSON is computed once at import
+_TOOL_SCHEMAS = [convert_to_openai_tool(t) for t in _TOOLS]
+
 # Main tool-enabled model
 llm = init_chat_model(
     model_provider="openai", model="gpt-4.1"
 )
-llm_with_tool = llm.bind_tools(tools=[create_folder, create_code_file, delete_folder, delete_file, run_project])
+# Independent tool calls from one response are executed concurrently by ToolNode
+llm_with_tool = llm.bind(tools=_TOOL_SCHEMAS, tool_choice="auto", parallel_tool_calls=True)
 
-# Lightweight helper model for rewrite / planning (no tools)
-helper_llm = init_chat_model(
-    model_provider="openai", model="gpt-4.1-mini"
-)
+# Lightweight helper model for rewrite / planning (no tools). Set HELPER_MODEL to
+# e.g. "ollama:qwen2.5:1.5b-instruct-q4_K_M" to run it locally via Ollama instead
+# (needs the optional `langchain-ollama` package from requirements.txt).
+HELPER_MODEL = os.getenv("HELPER_MODEL", "openai:gpt-4.1-nano")
+helper_llm = init_chat_model(HELPER_MODEL)
 
 
-def rewrite_node(state: State) -> State:
-    """Rewrite the latest user request into a precise instruction."""
-    user_msg = None
-    for m in reversed(state["messages"]):
-        if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
-            user_msg = m
-            break
-    if user_msg is None:
-        return state
+class RewriteAndPlan(TypedDict):
+    """Rewritten instruction and internal plan for the latest user request."""
 
-    content = getattr(user_msg, "content", None) or ""
-    prompt = (
-        "Rewrite the following user request into a single, precise instruction, "
-        "keeping all important details but removing ambiguity. "
-        "Respond with only the rewritten instruction.\n\n"
-        f"User request:\n{content}"
+    rewritten: str
+    plan: str
+
+
+helper_llm_structured = helper_llm.with_structured_output(RewriteAndPlan)
+
+# Optional semantic cache of rewrite/plan results (enable with PLAN_CACHE_ENABLED=1)
+plan_cache = None
+if os.getenv("PLAN_CACHE_ENABLED") == "1":
+    plan_cache = PlanCache(
+        path=os.getenv("PLAN_CACHE_PATH", "plan_cache.sqlite3"),
+        threshold=float(os.getenv("PLAN_CACHE_THRESHOLD", "0.92")),
     )
-    rewritten = helper_llm.invoke(prompt)
-    rewritten_text = getattr(rewritten, "content", "") or ""
 
-    return {**state, "rewritten_prompt": rewritten_text}
 
+# Optional cache of successful tool-call rounds, replayed for identical requests
+# without calling the main model (enable with PLAN_REPLAY_ENABLED=1)
+tool_call_cache = None
+if os.getenv("PLAN_REPLAY_ENABLED") == "1":
+    tool_call_cache = ReplayCache(path=os.getenv("PLAN_CACHE_PATH", "plan_cache.sqlite3"))
 
-def plan_node(state: State) -> State:
-    """Produce a short high-level internal plan for how to handle the request."""
-    user_text = ""
-    for m in reversed(state["messages"]):
-        if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
-            user_text = getattr(m, "content", "") or ""
-            break
 
-    rewritten = state.get("rewritten_prompt") or user_text
+@functools.lru_cache(maxsize=512)
+def _rewrite_and_plan_cached(user_text: str) -> tuple[str, str]:
+    """Return (rewritten instruction, plan) for `user_text`, memoized on the exact text."""
+    vector = None
+    if plan_cache is not None:
+        vector, cached = plan_cache.lookup(user_text)
+        if cached is not None:
+            # The rewrite restates another request's details, so only an exact hit may reuse it
+            if cached.get("text") == user_text:
+                return cached["rewritten"], cached["plan"]
+            return user_text, cached["plan"]
 
     prompt = (
-        "You are a silent planner for a coding assistant.\n"
-        "Given the original user request and a rewritten, clearer instruction,\n"
-        "produce a short, high-level plan (3–6 bullet points) of steps the assistant should take.\n"
-        "Focus on understanding, which tools to use (folder/file/delete/run), and output format.\n"
+        "You are a silent rewriter and planner for a coding assistant.\n"
+        "Given the user request below, return two fields:\n"
+        "- rewritten: the request as a single, precise instruction, keeping all important "
+        "details but removing ambiguity.\n"
+        "- plan: a short, high-level plan (3–6 bullet points) of steps the assistant should take. "
+        "Focus on understanding, which tools to use (folder/file/delete/run), and output format. "
         "Do NOT include code, only the plan. Keep it under 120 words.\n\n"
-        f"Original request:\n{user_text}\n\n"
-        f"Rewritten instruction:\n{rewritten}"
+        f"User request:\n{user_text}"
     )
-    plan_msg = helper_llm.invoke(prompt)
-    plan_text = getattr(plan_msg, "content", "") or ""
+    result = helper_llm_structured.invoke(prompt)
+    rewritten_text = result.get("rewritten") or ""
+    plan_text = result.get("plan") or ""
+
+    if plan_cache is not None:
+        plan_cache.insert(
+            user_text, {"text": user_text, "rewritten": rewritten_text, "plan": plan_text}, vector
+        )
+
+    return rewritten_text, plan_text
+
+
+def ingest_node(state: State):
+    """Record the text of the user message that started this turn.
+
+    At turn start the new user message is always the last one, so later nodes can
+    read `latest_user` instead of scanning the whole history.
+    """
+    last = state["messages"][-1] if state["messages"] else None
+    if getattr(last, "type", None) != "human":
+        return {}
+    # Clear the previous turn's helper output so a skipped rewrite/plan is not reused
+    return {
+        "latest_user": getattr(last, "content", "") or "",
+        "rewritten_prompt": None,
+        "plan": None,
+        "replayed": None,
+        "replay_rounds": None,
+    }
+
+
+# Short, direct tool commands ("create folder netflix", "delete file index.html", "run the project").
+# The whole utterance must be the command: one folder/file name, or run/serve/start plus a
+# concrete object, so anything with extra clauses ("... and add", "... with a hero") is planned.
+_SIMPLE_COMMAND = re.compile(
+    r"^\s*(?:please\s+)?(?:"
+    r"(?:create|make|delete|remove)\s+(?:a\s+|an\s+|the\s+)?(?:new\s+|empty\s+)?(?:folder|directory|file)"
+    r"\s+(?:called\s+|named\s+)?[\w.-]+"
+    r"|(?:run|serve|start)\s+(?:the\s+|my\s+)?(?:project|server|site|website)"
+    r")\s*(?:please)?[.!]?\s*$",
+    re.IGNORECASE,
+)
 
-    return {**state, "plan": plan_text}
+
+def classify_request(state: State) -> str:
+    """Label the request "simple" (already precise, skip rewrite/plan) or "complex"."""
+    text = state.get("latest_user") or ""
+    if len(text) < 80 and _SIMPLE_COMMAND.match(text):
+        return "simple"
+    return "complex"
+
+
+def rewrite_and_plan_node(state: State) -> State:
+    """Rewrite the latest user request and plan how to handle it in one helper call."""
+    user_text = state.get("latest_user")
+    if user_text is None:
+        return state
+
+    rewritten_text, plan_text = _rewrite_and_plan_cached(user_text)
+
+    return {**state, "rewritten_prompt": rewritten_text, "plan": plan_text}
+
+
+# Static part of the chatbot system prompt. It is sent first and never changes
+# between turns, so OpenAI's automatic prompt caching can reuse it.
+STATIC_SYSTEM_PREFIX = """
+You are an AI coding assistant.
+
+WORKSPACE RULES
+----------------
+- All work happens under the `chat_gpt/` directory.
+- For each logical project (e.g. "Netflix landing page"), reuse the SAME folder
+  (e.g. `chat_gpt/netflix_landing`) and UPDATE existing files via `create_code_file`
+  instead of creating duplicates.
+
+TOOLS
+-----
+- `create_folder`: create project folders under chat_gpt/.
+- `create_code_file`: create/update files (index.html, style.css, script.js, .py, etc.)
+  optionally inside a specific project folder.
+- `delete_folder`: delete a whole project folder under chat_gpt/.
+- `delete_file`: delete specific files under chat_gpt/ or a project folder.
+- `run_project`: serve chat_gpt/ at http://localhost:8000.
+
+BEHAVIOR
+--------
+- Use tools to actually create/update/delete/run projects, not shell commands.
+- Prefer updating existing project files in-place when the user asks for changes.
+- When several independent steps are needed (e.g. writing index.html, style.css and script.js),
+  issue all of those tool calls together in a single response instead of one per turn.
+  Files create their folder automatically; never write the same file twice in one response.
+- Keep explanations to the user clear and concise; do not expose the internal plan.
+"""
+
+static_prompt = SystemMessage(content=STATIC_SYSTEM_PREFIX)
+
+# Constant pieces of the per-turn context message; chatbot joins them around the dynamic values
+_CONTEXT_REQUEST = "CONTEXT\n-------\nOriginal user request:\n"
+_CONTEXT_REWRITTEN = "\n\nRewritten, precise instruction:\n"
+_CONTEXT_PLAN = "\n\nHigh-level internal plan (do not repeat verbatim to the user):\n"
+_CONTEXT_SUMMARY = "\n\nSummary of earlier conversation:\n"
+
+
+# Earlier turns sent to the main model are trimmed to roughly this many tokens
+HISTORY_TOKEN_BUDGET = 2000
+# Once the history grows past this many messages it is folded into a rolling summary
+SUMMARY_TRIGGER = 40
+
+
+def _current_turn_start(messages: list) -> int:
+    """Index of the user message that started the current turn (scans only this turn)."""
+    i = len(messages) - 1
+    while i > 0 and getattr(messages[i], "type", None) != "human":
+        i -= 1
+    return i
+
+
+def _trimmed_messages(messages: list) -> list:
+    """Keep the current turn whole and only the most recent earlier history."""
+    turn_start = _current_turn_start(messages)
+    history = trim_messages(
+        messages[:turn_start],
+        max_tokens=HISTORY_TOKEN_BUDGET,
+        strategy="last",
+        token_counter=llm,
+        include_system=True,
+        start_on="human",
+    )
+    return history + messages[turn_start:]
 
 
 def chatbot(state: State):
     """Main chat node that uses original text + rewritten prompt + plan with tools."""
-    original_user_text = ""
-    for m in reversed(state["messages"]):
-        if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
-            original_user_text = getattr(m, "content", "") or ""
-            break
+    original_user_text = state.get("latest_user") or ""
 
     rewritten = state.get("rewritten_prompt") or original_user_text
     plan = state.get("plan") or ""
+    summary = state.get("summary") or "(none)"
+
+    context_prompt = SystemMessage(content="".join((
+        _CONTEXT_REQUEST, original_user_text,
+        _CONTEXT_REWRITTEN, rewritten,
+        _CONTEXT_PLAN, plan,
+        _CONTEXT_SUMMARY, summary,
+    )))
 
-    system_prompt = SystemMessage(content=f"""
-        You are an AI coding assistant.
-
-        CONTEXT
-        -------
-        Original user request:
-        {original_user_text}
-
-        Rewritten, precise instruction:
-        {rewritten}
-
-        High-level internal plan (do not repeat verbatim to the user):
-        {plan}
-
-        WORKSPACE RULES
-        ----------------
-        - All work happens under the `chat_gpt/` directory.
-        - For each logical project (e.g. "Netflix landing page"), reuse the SAME folder
-          (e.g. `chat_gpt/netflix_landing`) and UPDATE existing files via `create_code_file`
-          instead of creating duplicates.
-
-        TOOLS
-        -----
-        - `create_folder`: create project folders under chat_gpt/.
-        - `create_code_file`: create/update files (index.html, style.css, script.js, .py, etc.)
-          optionally inside a specific project folder.
-        - `delete_folder`: delete a whole project folder under chat_gpt/.
-        - `delete_file`: delete specific files under chat_gpt/ or a project folder.
-        - `run_project`: serve chat_gpt/ at http://localhost:8000.
-
-        BEHAVIOR
-        --------
-        - Use tools to actually create/update/delete/run projects, not shell commands.
-        - Prefer updating existing project files in-place when the user asks for changes.
-        - Keep explanations to the user clear and concise; do not expose the internal plan.
-    """)
-
-    message = llm_with_tool.invoke([system_prompt] + state["messages"])
+    message = llm_with_tool.invoke([static_prompt, context_prompt] + _trimmed_messages(state["messages"]))
     return {"messages": [message]}
 
 
-tool_node = ToolNode(tools=[create_folder, create_code_file, delete_folder, delete_file, run_project])
+def summarize_node(state: State):
+    """Fold everything before the current turn into the rolling summary and drop it from state."""
+    messages = state["messages"]
+    old = messages[:_current_turn_start(messages)]
+    if not old:
+        return {}
+
+    transcript = "\n".join(
+        f"{m.type}: {m.content}" for m in old if isinstance(m.content, str) and m.content
+    )
+    prompt = (
+        "You maintain a running summary of a conversation between a user and an AI coding assistant.\n"
+        "Update the summary with the new messages below. Keep project/folder/file names, what was\n"
+        "created, changed, deleted or run, and any open requests. Keep it under 200 words.\n\n"
+        f"Current summary:\n{state.get('summary') or '(none)'}\n\n"
+        f"New messages:\n{transcript}"
+    )
+    summary_msg = helper_llm.invoke(prompt)
+    summary_text = getattr(summary_msg, "content", "") or ""
+
+    return {"summary": summary_text, "messages": [RemoveMessage(id=m.id) for m in old]}
+
+
+# Replayed calls must name a current tool; destructive tools are never recorded or
+# replayed without a model in the loop
+_TOOL_MAP = {t.name: t for t in _TOOLS}
+_REPLAY_EXCLUDED_TOOLS = {"delete_file", "delete_folder"}
+
+
+def _tool_failed(message: ToolMessage) -> bool:
+    return message.status == "error" or str(message.content).startswith("Failed")
+
+
+def _replayable(call: dict) -> bool:
+    return call["name"] in _TOOL_MAP and call["name"] not in _REPLAY_EXCLUDED_TOOLS
+
+
+def _overwrites_file(call: dict) -> bool:
+    """True if replaying `call` would overwrite a file that exists now (and may have been edited since)."""
+    if call["name"] != "create_code_file":
+        return False
+    try:
+        return _resolve(call["args"].get("folder_name") or None, call["args"]["filename"]).exists()
+    except (KeyError, ValueError):
+        return True
+
+
+def _replay_eligible(state: State) -> bool:
+    """Only standalone, explicit commands are recorded or replayed.
+
+    Context-dependent requests ("yes", "do it", "make it blue") mean something different
+    in every conversation, so their tool calls must never be reused.
+    """
+    return tool_call_cache is not None and classify_request(state) == "simple"
+
+
+def hydrate_node(state: State):
+    """Look up recorded tool-call rounds for exactly this request, to replay instead of asking any LLM."""
+    if not _replay_eligible(state):
+        return {}
+    # Keyed on the raw utterance, never on a rewritten prompt that may itself come from a cache
+    cached = tool_call_cache.get(state.get("latest_user") or "")
+    if cached is None:
+        return {}
+    calls = [call for calls in cached["rounds"] for call in calls]
+    if not all(_replayable(call) for call in calls) or any(_overwrites_file(call) for call in calls):
+        return {}
+    return {"replayed": True, "replay_rounds": cached["rounds"]}
+
+
+def replay_node(state: State):
+    """Issue the next recorded round of tool calls, then close the turn.
+
+    Rounds are replayed one at a time, in their original order, so calls that depended on
+    an earlier round never race with it. If any replayed call failed the turn is handed
+    back to the chatbot.
+    """
+    turn = state["messages"][_current_turn_start(state["messages"]):]
+    results = [m for m in turn if isinstance(m, ToolMessage)]
+    if any(_tool_failed(m) for m in results):
+        return {"replayed": False, "replay_rounds": None}
+
+    rounds = state.get("replay_rounds") or []
+    if rounds:
+        tool_calls = [
+            {"name": call["name"], "args": call["args"], "id": f"call_{uuid.uuid4().hex}", "type": "tool_call"}
+            for call in rounds[0]
+        ]
+        return {"replay_rounds": rounds[1:], "messages": [AIMessage(content="", tool_calls=tool_calls)]}
+
+    names = ", ".join(m.name or "tool" for m in results)
+    return {"messages": [AIMessage(content=f"Done. I repeated the steps from an earlier identical request: {names}.")]}
+
+
+def record_node(state: State):
+    """Store the tool-call rounds of a turn that completed without tool failures, for later replay."""
+    if not _replay_eligible(state):
+        return {}
+    turn = state["messages"][_current_turn_start(state["messages"]):]
+    # One round per chatbot response, preserving the order the calls were made in
+    rounds = [
+        [{"name": call["name"], "args": call["args"]} for call in m.tool_calls]
+        for m in turn
+        if isinstance(m, AIMessage) and m.tool_calls
+    ]
+    if not rounds or not all(_replayable(call) for calls in rounds for call in calls):
+        return {}
+    if any(_tool_failed(m) for m in turn if isinstance(m, ToolMessage)):
+        return {}
+
+    tool_call_cache.put(state.get("latest_user") or "", {"rounds": rounds})
+    return {}
+
+
+def route_after_hydrate(state: State) -> str:
+    """Replay recorded tool calls directly; otherwise classify the request for the chatbot."""
+    if state.get("replayed"):
+        return "replay"
+    return "chatbot" if classify_request(state) == "simple" else "rewrite_and_plan"
+
+
+def route_after_tools(state: State) -> str:
+    """Continue a replay; otherwise feed tool output back to the chatbot."""
+    return "replay" if state.get("replayed") else "chatbot"
+
+
+def route_after_replay(state: State) -> str:
+    """Run the next replayed round, end a finished replay, or fall back to the chatbot."""
+    if not state.get("replayed"):
+        return "chatbot"
+    if tools_condition(state) == "tools":
+        return "tools"
+    return route_to_end(state)
+
+
+def route_after_chatbot(state: State) -> str:
+    """Run requested tools; otherwise record the finished turn."""
+    if tools_condition(state) == "tools":
+        return "tools"
+    return "record"
+
+
+def route_to_end(state: State) -> str:
+    """Fold a long history into the summary before ending the turn."""
+    if len(state["messages"]) > SUMMARY_TRIGGER:
+        return "summarize"
+    return END
+
+
+tool_node = ToolNode(tools=_TOOLS)
 
 graph_builder = StateGraph(State)
 
-# New pipeline: START -> rewrite -> plan -> chatbot -> tools/END
-graph_builder.add_node("rewrite", rewrite_node)
-graph_builder.add_node("plan", plan_node)
+# Pipeline: START -> ingest -> hydrate -> [rewrite_and_plan] -> chatbot <-> tools -> record -> [summarize] -> END
+# (a replayed turn goes hydrate -> replay <-> tools, skipping both the helper and the chatbot)
+graph_builder.add_node("ingest", ingest_node)
+graph_builder.add_node("rewrite_and_plan", rewrite_and_plan_node)
+graph_builder.add_node("hydrate", hydrate_node)
 graph_builder.add_node("chatbot", chatbot)
 graph_builder.add_node("tools", tool_node)
-
-graph_builder.add_edge(START, "rewrite")
-graph_builder.add_edge("rewrite", "plan")
-graph_builder.add_edge("plan", "chatbot")
-
-graph_builder.add_conditional_edges(
-    "chatbot",
-    tools_condition,
-)
-graph_builder.add_edge("tools", "chatbot")
-graph_builder.add_edge("chatbot", END)
+graph_builder.add_node("replay", replay_node)
+graph_builder.add_node("record", record_node)
+graph_builder.add_node("summarize", summarize_node)
+
+graph_builder.add_edge(START, "ingest")
+graph_builder.add_edge("ingest", "hydrate")
+graph_builder.add_conditional_edges("hydrate", route_after_hydrate, ["replay", "chatbot", "rewrite_and_plan"])
+graph_builder.add_edge("rewrite_and_plan", "chatbot")
+
+graph_builder.add_conditional_edges("chatbot", route_after_chatbot, ["tools", "record"])
+graph_builder.add_conditional_edges("tools", route_after_tools, ["replay", "chatbot"])
+graph_builder.add_conditional_edges("replay", route_after_replay, ["tools", "chatbot", "summarize", END])
+graph_builder.add_conditional_edges("record", route_to_end, ["summarize", END])
+graph_builder.add_edge("summarize", END)
 
 graph = graph_builder.compile()
 
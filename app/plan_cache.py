@@ -0,0 +1,114 @@
+import json
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_openai import OpenAIEmbeddings
+
+
+class PlanCache:
+    """Semantic cache of helper LLM results, keyed by the embedding of the user text.
+
+    Rows are stored in sqlite so the cache survives restarts. The vectors are also
+    kept in memory as an L2-normalized matrix, so a nearest-neighbor lookup is a
+    single matrix-vector product (cosine similarity).
+    """
+
+    def __init__(
+        self,
+        path: str = "plan_cache.sqlite3",
+        table: str = "plans",
+        threshold: float = 0.92,
+        embeddings=None,
+    ):
+        self.table = table
+        self.threshold = threshold
+        self.embeddings = embeddings or OpenAIEmbeddings(model="text-embedding-3-small")
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "id INTEGER PRIMARY KEY, text TEXT NOT NULL, embedding BLOB NOT NULL, payload TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+        rows = self._conn.execute(f"SELECT embedding, payload FROM {table} ORDER BY id").fetchall()
+        self._payloads = [json.loads(payload) for _, payload in rows]
+        self._vectors = [np.frombuffer(blob, dtype=np.float32) for blob, _ in rows]
+        self._matrix = np.vstack(self._vectors) if self._vectors else None
+
+    def embed(self, text: str) -> np.ndarray:
+        """Return the normalized embedding for `text`."""
+        vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, text: str) -> tuple[np.ndarray, dict | None]:
+        """Return the embedding of `text` and the closest cached payload above the threshold.
+
+        The embedding is returned so a miss can be inserted without embedding twice.
+        """
+        vector = self.embed(text)
+        with self._lock:
+            if self._matrix is None:
+                return vector, None
+            scores = self._matrix @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return vector, self._payloads[best]
+        return vector, None
+
+    def insert(self, text: str, payload: dict, vector: np.ndarray | None = None) -> None:
+        """Store `payload` under the embedding of `text`."""
+        if vector is None:
+            vector = self.embed(text)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO {self.table} (text, embedding, payload) VALUES (?, ?, ?)",
+                (text, vector.tobytes(), json.dumps(payload)),
+            )
+            self._conn.commit()
+            self._payloads.append(payload)
+            self._vectors.append(vector)
+            self._matrix = np.vstack(self._vectors)
+
+
+class ReplayCache:
+    """Exact-match cache of recorded tool-call rounds, keyed by the normalized user request.
+
+    There is deliberately no similarity search: replayed tool calls run without a model
+    in the loop, so only a request that normalizes to the same text may reuse them.
+    """
+
+    def __init__(self, path: str = "plan_cache.sqlite3", table: str = "tool_call_rounds"):
+        self.table = table
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, payload TEXT NOT NULL)")
+        self._conn.commit()
+
+        rows = self._conn.execute(f"SELECT key, payload FROM {table}").fetchall()
+        self._entries = {key: json.loads(payload) for key, payload in rows}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Lowercase, collapse whitespace and drop surrounding punctuation."""
+        return " ".join(text.lower().split()).strip(" .,!?")
+
+    def get(self, text: str) -> dict | None:
+        """Return the payload stored for `text`, if any."""
+        with self._lock:
+            return self._entries.get(self.normalize(text))
+
+    def put(self, text: str, payload: dict) -> None:
+        """Store `payload` for `text`, replacing any earlier entry."""
+        key = self.normalize(text)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, payload) VALUES (?, ?)",
+                (key, json.dumps(payload)),
+            )
+            self._conn.commit()
+            self._entries[key] = payload